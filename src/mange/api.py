@@ -11,7 +11,7 @@ import pickle
 import time
 
 from sqlalchemy import create_engine
-from sqlalchemy.sql import text, select
+from sqlalchemy.sql import text, select, insert
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from mange.conf import settings
@@ -97,8 +97,6 @@ class Client:
 
         self.engine = create_engine(url)
 
-        self.engine = create_engine(url)
-
         self.session = scoped_session(sessionmaker(bind=self.engine, **config))  # pylint: --disable=C0103
 
     def __delete__(self, obj):
@@ -231,7 +229,34 @@ class Client:
             sobre_limite=over_limit,
             costo=cost,
         )
-    
+
+    def liquidate_bills_bulk(self, pairs):
+        """
+        Liquidate many bills at once. Unlike liquidate_bill, the new registros
+        are not returned, query them if you need them.
+        :param pairs: iterable of (company, date) tuples
+        """
+        rows = []
+        for company, date in pairs:
+            rows.append(
+                {
+                    "id_sucursal": company.id,
+                    "fecha": date or datetime.today(),
+                    "lectura": company.reading,
+                    "sobre_limite": company.over_limit,
+                    "costo": company.calculate(),
+                }
+            )
+            company.last_reading = company.reading
+
+        if not rows:
+            return
+
+        # one executemany instead of a flush per object, no RETURNING so sqlite
+        # doesn't fall back to an INSERT per row
+        self.session.execute(insert(Registro), rows)
+        self.session.commit()
+
     # high-level
     def total_consumption(self, company, start_date, end_date):
         # select * between start_date and end_date
@@ -262,5 +287,5 @@ class Client:
         return self._get(Registro).filter(Registro.fecha >= start_date).filter(Registro.fecha <= end_date).all()
 
     def list_alerts(self, company):
-        # select * where over_limit>1 and company_id = company.id
-        return self._get(Registro, company_id=company.id).filter(Registro.sobre_limite > 0).all()
+        # select * where over_limit>1 and id_sucursal = company.id
+        return self._get(Registro, id_sucursal=company.id).filter(Registro.sobre_limite > 0).all()
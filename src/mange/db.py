@@ -1,37 +1,40 @@
 """
 ORM layer for the DB
 """
+import contextlib
+import keyword
 import os
-from enum import Enum
 import logging
 import shutil
-import random
-import re
-import pathlib
 from warnings import warn
-import pickle
-import base64
 
-from sqlalchemy import Column, create_engine, func
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from sqlalchemy import Column, create_engine, event
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy import (
     Integer,
-    Float,
     String,
-    Text,
     Boolean,
     ForeignKey,
     DateTime,
 )
-from sqlalchemy.sql import text
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship, as_declarative, validates
-from sqlalchemy.schema import UniqueConstraint, CheckConstraint
+from sqlalchemy.orm import relationship, as_declarative
 
 from mange.conf import settings
-from mange.log import logged
+import mange.log  # noqa: F401 configures the loggers
 
 logger = logging.getLogger("user_info." + __name__)
 
+# linux/ioctl.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# files whose timestamp was already checked and recorded by this process
+_CHECKED_FILES: set = set()
+
 
 @as_declarative()
 class Base:
@@ -39,30 +42,58 @@ class Base:
 
     @declared_attr
     def __tablename__(cls):  # pylint: --disable=no-self-argument
-        cls_name = cls.__name__
-        table_name = list(cls_name)
-        for index, match in enumerate(re.finditer("[A-Z]", cls_name[1:])):
-            table_name.insert(match.end() + index, "_")
-        table_name = "".join(table_name).lower()
+        table_name = cls.__dict__.get("_cached_tablename")
+        if table_name is None:
+            cls_name = cls.__name__
+            table_name = cls_name[0] + "".join(
+                ["_" + char if "A" <= char <= "Z" else char for char in cls_name[1:]]
+            )
+            table_name = table_name.lower()
+            cls._cached_tablename = table_name
         return table_name
 
     def as_dict(self):
         """
         I won't recursively serialialize all related fields because it will cause trouble
         with circular dependencies (for example, in Location, Paths can lead eventually to the same Location)
+
+        Fallback only: configured models get a generated as_dict (see _set_column_names)
+        unless they define their own.
         """
-        return {
-            column: getattr(self, column) for column in self.__table__.columns.keys()
-        }
+        return {column: getattr(self, column) for column in self.__mapper__.column_attrs.keys()}
 
     def __str__(self):
-        return f"[ {self.__class__.__name__} ] ({self.as_dict()})"
+        return f"[ {type(self).__name__} ] ({self.as_dict()})"
 
-    def __repr__(self):
-        return self.__str__()
+    __repr__ = __str__
 
     id = Column(Integer, primary_key=True, nullable=False)
 
+
+@event.listens_for(Base, "mapper_configured", propagate=True)
+def _set_column_names(mapper, cls):
+    cls._COLUMN_NAMES = tuple(mapper.column_attrs.keys())
+
+    # don't replace an as_dict written by hand (here or in a parent model)
+    if cls.as_dict is not Base.as_dict and not getattr(cls.as_dict, "_generated", False):
+        return
+
+    # specialize as_dict to a single dict literal for this class
+    items = ", ".join(
+        f"{column!r}: self.{column}"
+        if column.isidentifier() and not keyword.iskeyword(column)
+        else f"{column!r}: getattr(self, {column!r})"
+        for column in cls._COLUMN_NAMES
+    )
+    namespace = {}
+    exec(f"def as_dict(self):\n    return {{{items}}}", namespace)
+    as_dict = namespace["as_dict"]
+    as_dict.__doc__ = Base.as_dict.__doc__
+    as_dict.__qualname__ = f"{cls.__name__}.as_dict"
+    as_dict._generated = True
+    cls.as_dict = as_dict
+
+
 class Sucursal(Base):
     nombre = Column(String, unique=True, nullable=False)
     tipo = Column(String)
@@ -140,25 +171,38 @@ def create_db(name=settings.DATABASES["default"]["engine"]):
     """
     Create database and schema if and only if the schema was modified
     """
-    file = name.split(os.sep)[-1]
-    master = "master_" + file
-    master_name = name.replace(file, master)
-
-    path = name.split("///")[-1].replace("(", "")
-    master_path = pathlib.Path(path.replace(file, master))
-    child_path = pathlib.Path(path)
+    url = make_url(name)
+    child_path = url.database
+    master_path = os.path.join(
+        os.path.dirname(child_path), "master_" + os.path.basename(child_path)
+    )
 
     # Nuke everything and build it from scratch.
-    if db_schema_modified("db.py") or not master_path.exists():
-        master_engine = create_engine(master_name)
-        Base.metadata.drop_all(master_engine)
-        Base.metadata.create_all(master_engine)
+    if db_schema_modified("db.py") or not os.path.exists(master_path):
+        master_engine = create_engine(url.set(database=master_path))
+        with master_engine.begin() as conn:
+            Base.metadata.drop_all(conn)
+            Base.metadata.create_all(conn)
 
-    shutil.copy(master_path, child_path)
+    _fast_copy(master_path, child_path)
+
+    return str(url)
 
-    engine = create_engine(name)
 
-    return str(engine.url)
+def _fast_copy(src, dst):
+    """
+    Clone `src` into `dst` sharing the data blocks when the filesystem supports it
+    (btrfs, XFS, ...). Fall back to a regular copy otherwise.
+    We don't hardlink because the child db is written to and that would change the master.
+    """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
 
 
 def drop_db(name=settings.DATABASES["default"]["engine"]):
@@ -166,43 +210,54 @@ def drop_db(name=settings.DATABASES["default"]["engine"]):
     Base.metadata.drop_all(engine)
 
 
-def db_schema_modified(filename):
+def db_schema_modified(filename, invalidate=False):
     """
     Utility tool to know if a file was modified.
-    :param file: Path object, file to watch
+    Once a file was checked it is reported as unmodified for the rest of the process.
+    :param filename: str or Path object, file to watch (relative to BASE_DIR)
+    :param invalidate: bool, check the file again even if it was already checked
     """
-    ts_file = (
-        settings.BASE_DIR
-        / f"_last_mod_{filename if isinstance(filename, str) else filename.name}.timestamp"
-    )
+    key = filename if isinstance(filename, str) else filename.name
+    if key in _CHECKED_FILES and not invalidate:
+        return False
+
+    ts_file = settings.BASE_DIR / f"_last_mod_{key}.timestamp"
     if not (settings.BASE_DIR / filename).exists():
         warn(f"{filename} does not exist")
         return
-    _last_schema_mod = os.stat(settings.BASE_DIR / filename).st_mtime
+    _last_schema_mod = os.stat(settings.BASE_DIR / filename).st_mtime_ns
     try:
-        with open(ts_file, encoding="utf-8") as file:
-            _lst_reg_schema_mod = file.read()
+        with open(ts_file, "rb") as file:
+            _lst_reg_schema_mod = int(file.read() or 0)
     except FileNotFoundError as exc:
         _, error = exc.args
         warn(error)
-        with open(ts_file, "w", encoding="utf-8") as file:
-            file.write(str(_last_schema_mod))
-            _lst_reg_schema_mod = 0
+        _lst_reg_schema_mod = 0
+    except ValueError:
+        # timestamp from before we stored nanoseconds
+        _lst_reg_schema_mod = 0
 
-    SCHEMA_MODIFIED = float(_lst_reg_schema_mod) != _last_schema_mod
+    SCHEMA_MODIFIED = _lst_reg_schema_mod != _last_schema_mod
     if SCHEMA_MODIFIED:
         logger.info("Detected change in %s ... db will be rebuilt", filename)
-        with open(ts_file, "w", encoding="utf-8") as file:
-            file.write(str(_last_schema_mod))
+        with open(ts_file, "wb") as file:
+            file.write(b"%d" % _last_schema_mod)
+
+    # the timestamp file is up to date now
+    _CHECKED_FILES.add(key)
 
     return SCHEMA_MODIFIED
 
 
-def load_backup(source: "Engine", dest: "Engine"):
+def load_backup(source: "Engine", dest: "Engine", pages=1024):
+    """
+    Copy `source` into `dest` `pages` pages at a time so other connections
+    are not locked out during the whole copy. Use -1 to copy everything in one step.
+    """
     if isinstance(dest, str):
         dest = create_engine(dest)
 
-    raw_src = source.raw_connection()
-    raw_dst = dest.raw_connection()
-    raw_src.driver_connection.backup(raw_dst.driver_connection)
-    raw_src.close()
+    with contextlib.closing(source.raw_connection()) as raw_src, contextlib.closing(
+        dest.raw_connection()
+    ) as raw_dst:
+        raw_src.driver_connection.backup(raw_dst.driver_connection, pages=pages)
@@ -3,6 +3,8 @@ import os
 from pathlib import Path
 import unittest
 
+from sqlalchemy import event
+
 from mange.db import *
 from mange.api import *
 from mange.conf import settings
@@ -20,6 +22,21 @@ def build_test_db(
     """
     engine = create_engine(name)
 
+    @event.listens_for(engine, "connect")
+    def _fast_sqlite(dbapi_connection, connection_record):
+        # we don't care about durability for test data
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+        # let sqlalchemy handle the transactions so savepoints work with pysqlite
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
     # Nuke everything and build it from scratch.
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
@@ -27,13 +44,31 @@ def build_test_db(
     return engine
 
 class Test_API(unittest.TestCase):
-    
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = build_test_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
     def setUp(self):
-        build_test_db()
+        # every test runs inside a transaction that is rolled back afterwards,
+        # the client commits become savepoints
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+
         self.client = Client()
+        self.client.session = scoped_session(
+            sessionmaker(bind=self.connection, join_transaction_mode="create_savepoint")
+        )
 
     def tearDown(self):
-        pass
+        self.client.session.close()
+        self.transaction.rollback()
+        self.connection.close()
+        self.client.engine.dispose()
 
     def test_login(self):
         user = self.client.create_user(name="blob", password="doko")
@@ -57,6 +92,31 @@ class Test_API(unittest.TestCase):
         registro = self.client.liquidate_bill(sucursal)
         self.assertEqual(registro.sobre_limite, 50)
 
+    def test_liquidate_bills_bulk(self):
+        first = self.client.create_sucursal(nombre="blobcorp", last_reading=0, reading=50, limite=100)
+        second = self.client.create_sucursal(nombre="blobinc", last_reading=0, reading=150, limite=100)
+        self.client.session.commit()
+
+        inserts = []
+
+        @event.listens_for(self.connection, "before_cursor_execute")
+        def _count_inserts(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("INSERT INTO registro"):
+                inserts.append(statement)
+
+        self.client.liquidate_bills_bulk(
+            [(first, datetime(2000, 10, 1)), (second, datetime(2000, 10, 1))]
+        )
+
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.client.get_registro(id_sucursal=first.id).one().sobre_limite, 0)
+        self.assertEqual(self.client.get_registro(id_sucursal=second.id).one().sobre_limite, 50)
+        self.assertEqual(second.last_reading, second.reading)
+
+    def test_liquidate_bills_bulk_empty(self):
+        self.client.liquidate_bills_bulk([])
+        self.assertEqual(self.client.get_registro().all(), [])
+
     def test_total_consumption(self):
         sucursal = self.client.create_sucursal(nombre="blobcorp", last_reading=0, reading=100, limite=9999)
         self.client.session.commit()
@@ -89,6 +149,14 @@ class Test_API(unittest.TestCase):
             [registro],
         )
 
+    def test_list_alerts(self):
+        sucursal = self.client.create_sucursal(nombre="blobcorp", last_reading=0, reading=1, limite=0)
+        other = self.client.create_sucursal(nombre="blobinc", last_reading=0, reading=1, limite=0)
+        self.client.session.commit()
+        registro = self.client.liquidate_bill(sucursal, date=datetime(2000, 10, 1))
+        self.client.liquidate_bill(other, date=datetime(2000, 10, 1))
+
+        self.assertEqual(self.client.list_alerts(sucursal), [registro])
 
 
 def main_suite() -> unittest.TestSuite: